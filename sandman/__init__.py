@@ -22,9 +22,19 @@ from sandman.content_negotiation import (
         HTML,
         )
 from sandman.admin import admin
+from sandman.batch import batch
+from sandman.changes import changes
+from sandman.search import is_index_table, search_index, DEFAULT_LANGUAGE
+from sandman.validation import Validator
+from sandman.admission import (
+        admit_request,
+        release_request,
+        retry_after_header,
+        )
 
 app = Flask(__name__)
 app.register_blueprint(admin, url_prefix='/admin')
+app.register_blueprint(batch)
 with app.app_context():
     g.class_registery = {}
 
@@ -52,8 +62,24 @@ def handle_application_error(error):
     HTML ones."""
     response = jsonify(error.to_dict())
     response.status_code = error.code
+    if getattr(error, 'retry_after', None) is not None:
+        response.headers['Retry-After'] = retry_after_header(
+            error.retry_after)
     return response
 
+
+@app.before_request
+def admission_control():
+    """Shed the request with a 503 if the server is over its configured
+    limits."""
+    admit_request(app)
+
+
+@app.teardown_request
+def release_admission(_):
+    """Give back the concurrency slots held by the request."""
+    release_request()
+
 @app.errorhandler(InvalidAPIUsage)
 def handle_exception(error):
     """Return a response with the appropriate status code, message, and content
@@ -98,10 +124,26 @@ def reflect_all():
 
         db.metadata.reflect(bind=db.engine)
         for name, table in db.metadata.tables.items():
+            if is_index_table(name):
+                continue
             new_cls = type(str(name), (Model,), {'__tablename__': str(name), '__table__': table})
             register([new_cls])
 
 
+def _search_index(cls, table):
+    """Return the search index for the model *cls* of *table*, or None if it
+    isn't searchable."""
+    searchable = getattr(cls, '__searchable__', None) or (
+        app.config.get('SANDMAN_SEARCHABLE', {}).get(cls.__tablename__))
+    if not searchable:
+        return None
+    return search_index(
+        table,
+        searchable,
+        db.engine.dialect,
+        app.config.get('SANDMAN_SEARCH_LANGUAGE', DEFAULT_LANGUAGE))
+
+
 def register(cls_list):
     """Register a class to be given a REST API."""
     with app.app_context():
@@ -116,6 +158,11 @@ def register(cls_list):
                 sqlalchemy_class = add_pk(db, cls)
             cls.__model__ = sqlalchemy_class
             cls.__app__ = app
+            cls.__validator__ = Validator(sqlalchemy_class.__table__)
+            cls.__search_index__ = _search_index(
+                cls, sqlalchemy_class.__table__)
+            if cls.__search_index__ is not None:
+                cls.__search_index__.ensure(db.engine)
             view_func = cls.as_view(
                 cls.__tablename__)
             app.add_url_rule(
@@ -130,3 +177,8 @@ def register(cls_list):
                     'DELETE',
                     'PATCH',
                     'OPTIONS'])
+            app.add_url_rule(
+                '/{resource}/changes'.format(resource=cls.endpoint()),
+                endpoint='{}_changes'.format(cls.__tablename__),
+                view_func=changes,
+                defaults={'endpoint': cls.endpoint()})
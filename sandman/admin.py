@@ -1,6 +1,9 @@
 """Admin module for sandman."""
 from __future__ import absolute_import
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, jsonify, current_app
+
+from sandman.admission import get_controller
+from sandman.coalesce import get_single_flight
 
 admin = Blueprint('admin', __name__)
 
@@ -9,3 +12,15 @@ admin = Blueprint('admin', __name__)
 def home():
     """Show the base admin view."""
     return render_template('admin/home.html')
+
+
+@admin.route('/admission')
+def admission():
+    """Return admission control queue depths and rejection counts."""
+    return jsonify(get_controller(current_app).stats())
+
+
+@admin.route('/coalescing')
+def coalescing():
+    """Return request coalescing counts and ratio."""
+    return jsonify(get_single_flight(current_app).stats())
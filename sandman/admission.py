@@ -0,0 +1,264 @@
+"""Admission control and load shedding.
+
+Requests are admitted against an optional global limit and optional
+per-endpoint limits, each made of a token bucket (requests per second) and a
+concurrency limit with a bounded wait queue. Requests which can't be
+admitted before their deadline are rejected immediately with a
+``503 Service Unavailable`` and a ``Retry-After`` header, rather than piling
+up behind the database.
+
+Configuration (all optional, limits are disabled when unset):
+
+* ``SANDMAN_MAX_CONCURRENT_REQUESTS``: requests processed at once
+* ``SANDMAN_MAX_QUEUED_REQUESTS``: requests allowed to wait for a slot
+* ``SANDMAN_QUEUE_TIMEOUT``: seconds a queued request waits before being shed
+* ``SANDMAN_RATE_LIMIT``: requests per second
+* ``SANDMAN_RATE_LIMIT_BURST``: token bucket size (defaults to the rate)
+* ``SANDMAN_RETRY_AFTER``: ``Retry-After`` sent when shedding on concurrency
+* ``SANDMAN_ENDPOINT_LIMITS``: dict of endpoint name to a dict with any of
+  the keys ``max_concurrent_requests``, ``max_queued_requests``,
+  ``queue_timeout``, ``rate_limit`` and ``rate_limit_burst``
+
+Views marked ``long_lived`` (the change feed) are exempt from the global
+concurrency limit, which they would otherwise fill while waiting for
+changes; they are still subject to the rate limits and to their own
+per-endpoint limits. A streamed response outlives its request, so a view
+streaming one takes over its slots with :func:`detach_request` and releases
+them once the stream is closed.
+
+Limits are per process; with ``sandman serve`` each worker enforces its own.
+"""
+import math
+import threading
+import time
+
+from flask import request
+
+from sandman.exception import ServiceUnavailableException
+
+DEFAULT_QUEUE_TIMEOUT = 1.0
+DEFAULT_RETRY_AFTER = 1
+
+
+class TokenBucket(object):
+    """Token bucket refilled at *rate* tokens per second, holding at most
+    *burst* tokens."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        # A bucket which can't hold a whole token would never admit anything,
+        # as for rates below one request per second
+        self.burst = max(1.0, float(burst or rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token. Return 0 on success, otherwise the number of seconds
+        until a token will be available."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class Limiter(object):
+    """Concurrency and rate limit for a single scope (global or one
+    endpoint)."""
+
+    def __init__(self, name, max_concurrent_requests=None,
+                 max_queued_requests=0, queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 rate_limit=None, rate_limit_burst=None,
+                 retry_after=DEFAULT_RETRY_AFTER):
+        self.name = name
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_queued_requests = max_queued_requests or 0
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.bucket = None
+        if rate_limit:
+            self.bucket = TokenBucket(rate_limit, rate_limit_burst)
+        self.condition = threading.Condition()
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.rate_limited = 0
+
+    def _shed(self, message, retry_after):
+        """Raise the 503 returned to a shed request."""
+        raise ServiceUnavailableException(
+            message,
+            payload={'scope': self.name},
+            retry_after=retry_after)
+
+    def check_rate(self):
+        """Reject the request if the token bucket is empty."""
+        if self.bucket is None:
+            return
+        wait = self.bucket.take()
+        if wait:
+            with self.condition:
+                self.rate_limited += 1
+            self._shed('rate limit exceeded', wait)
+
+    def acquire(self):
+        """Take a concurrency slot, waiting in the bounded queue if
+        necessary."""
+        if not self.max_concurrent_requests:
+            return
+        with self.condition:
+            if self.active < self.max_concurrent_requests:
+                self.active += 1
+                self.admitted += 1
+                return
+            if self.queued >= self.max_queued_requests:
+                self.rejected += 1
+                self._shed('server overloaded', self.retry_after)
+            self.queued += 1
+            deadline = time.time() + self.queue_timeout
+            try:
+                while self.active >= self.max_concurrent_requests:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        self._shed('timed out waiting for capacity',
+                                   self.retry_after)
+                    self.condition.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.active += 1
+            self.admitted += 1
+
+    def release(self):
+        """Give back a concurrency slot taken by :meth:`acquire`."""
+        if not self.max_concurrent_requests:
+            return
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        """Return a dictionary of this limiter's counters."""
+        with self.condition:
+            return {
+                'active': self.active,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'rate_limited': self.rate_limited,
+                'max_concurrent_requests': self.max_concurrent_requests,
+                'max_queued_requests': self.max_queued_requests,
+                }
+
+
+class AdmissionController(object):
+    """Holds the global limiter and the per-endpoint limiters for an
+    application."""
+
+    def __init__(self, config):
+        retry_after = config.get('SANDMAN_RETRY_AFTER', DEFAULT_RETRY_AFTER)
+        self.retry_after = retry_after
+        self.limiter = Limiter(
+            'global',
+            max_concurrent_requests=config.get(
+                'SANDMAN_MAX_CONCURRENT_REQUESTS'),
+            max_queued_requests=config.get('SANDMAN_MAX_QUEUED_REQUESTS', 0),
+            queue_timeout=config.get(
+                'SANDMAN_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT),
+            rate_limit=config.get('SANDMAN_RATE_LIMIT'),
+            rate_limit_burst=config.get('SANDMAN_RATE_LIMIT_BURST'),
+            retry_after=retry_after)
+        self.endpoint_limiters = {}
+        for endpoint, limits in config.get(
+                'SANDMAN_ENDPOINT_LIMITS', {}).items():
+            limits = dict(limits)
+            limits.setdefault('retry_after', retry_after)
+            self.endpoint_limiters[endpoint] = Limiter(endpoint, **limits)
+
+    def admit(self, endpoint, global_slot=True):
+        """Admit a request to *endpoint*, returning the limiters holding a
+        slot for it. Raises :class:`ServiceUnavailableException` if the
+        request is shed.
+
+        Without a *global_slot* the request is charged against every rate
+        limit and its endpoint's concurrency limit, but not the global
+        concurrency limit.
+        """
+        limiters = [self.limiter]
+        if endpoint in self.endpoint_limiters:
+            limiters.insert(0, self.endpoint_limiters[endpoint])
+        # Rate limits are checked first as they never wait
+        for limiter in limiters:
+            limiter.check_rate()
+        acquired = []
+        try:
+            for limiter in limiters:
+                if not global_slot and limiter is self.limiter:
+                    continue
+                limiter.acquire()
+                acquired.append(limiter)
+        except ServiceUnavailableException:
+            for limiter in acquired:
+                limiter.release()
+            raise
+        return acquired
+
+    def stats(self):
+        """Return queue depths and rejection counts for every limiter."""
+        return {
+            'global': self.limiter.stats(),
+            'endpoints': dict(
+                (endpoint, limiter.stats())
+                for endpoint, limiter in self.endpoint_limiters.items()),
+            }
+
+
+def get_controller(app):
+    """Return (and memoize) the :class:`AdmissionController` for *app*."""
+    controller = app.extensions.get('sandman_admission')
+    if controller is None:
+        controller = app.extensions['sandman_admission'] = (
+            AdmissionController(app.config))
+    return controller
+
+
+def admit_request(app, sub_request=False):
+    """Admit the current request or shed it. Meant to run before each
+    request, and before each sub-request of a batch."""
+    if request.endpoint is None or request.endpoint.startswith('admin.'):
+        # Never shed 404s or the admin (and metrics) views
+        return
+    # A batch already holds a global slot for its sub-requests
+    long_lived = getattr(
+        app.view_functions.get(request.endpoint), 'long_lived', False)
+    global_slot = not (sub_request or long_lived)
+    # Kept in the environ rather than on ``g``, which in-process sub-requests
+    # (see :mod:`sandman.batch`) share with the request that dispatched them
+    request.environ['sandman.admitted'] = get_controller(app).admit(
+        request.endpoint, global_slot)
+
+
+def release_request():
+    """Release any slots held by the current request. Meant to run on request
+    teardown."""
+    for limiter in request.environ.pop('sandman.admitted', ()):
+        limiter.release()
+
+
+def detach_request():
+    """Return the limiters holding slots for the current request, leaving the
+    caller to release them rather than the request's teardown."""
+    return request.environ.pop('sandman.admitted', ())
+
+
+def retry_after_header(seconds):
+    """Return *seconds* formatted for the ``Retry-After`` header."""
+    return str(max(1, int(math.ceil(seconds))))
@@ -0,0 +1,128 @@
+"""Batch endpoint dispatching many sub-requests in a single HTTP request.
+
+``POST /batch`` takes a JSON body of the form::
+
+    {
+        "atomic": false,
+        "requests": [
+            {"method": "GET", "path": "/artists/1"},
+            {"method": "PATCH", "path": "/artists/2", "body": {"Name": "..."}}
+        ]
+    }
+
+Sub-requests are dispatched in order, in-process, to the registered views
+and share a single database session. Every sub-request of an ``atomic``
+batch runs in one transaction: the batch stops at the first failed
+sub-request and nothing is committed. The response holds the status and
+body of each sub-request that was run.
+
+``SANDMAN_BATCH_MAX_SIZE`` caps the number of sub-requests in a batch.
+"""
+import json
+
+from flask import Blueprint, current_app, g, jsonify, request
+
+from sandman.admission import admit_request
+from sandman.changes import get_bus
+from sandman.exception import BadRequestException
+from sandman.models import _get_session
+
+DEFAULT_MAX_SIZE = 50
+
+batch = Blueprint('batch', __name__)
+
+
+def _dispatch(method, path, body):
+    """Run a single sub-request and return its response."""
+    path, _, query_string = path.partition('?')
+    data = None
+    if body is not None:
+        data = json.dumps(body)
+    with current_app.test_request_context(
+            path,
+            method=method,
+            query_string=query_string,
+            data=data,
+            content_type='application/json',
+            headers={'Accept': 'application/json'}):
+        try:
+            if request.routing_exception is not None:
+                raise request.routing_exception
+            if request.url_rule.endpoint == 'batch.dispatch':
+                raise BadRequestException('batches can not be nested')
+            # Each sub-request is subject to the same limits as if it had
+            # been made on its own; its slots are released on teardown
+            admit_request(current_app, sub_request=True)
+            response = current_app.view_functions[request.url_rule.endpoint](
+                **request.view_args)
+        except Exception as exception:  # pylint: disable=broad-except
+            try:
+                response = current_app.handle_user_exception(exception)
+            except Exception:  # pylint: disable=broad-except
+                # Report the failure for this sub-request alone, so the
+                # client can still tell which of the others succeeded
+                current_app.logger.exception(
+                    'Batch sub-request [%s %s] failed', method, path)
+                _get_session().rollback()
+                return current_app.response_class(status=500)
+        return current_app.make_response(response)
+
+
+def _as_result(response):
+    """Return the JSON representation of a sub-request's *response*."""
+    body = response.get_data(as_text=True)
+    if body and response.mimetype == 'application/json':
+        body = json.loads(body)
+    return {'status': response.status_code, 'body': body or None}
+
+
+@batch.route('/batch', methods=['POST'])
+def dispatch():
+    """Return the responses to a batch of sub-requests."""
+    data = request.get_json(force=True, silent=True)
+    if not data or not isinstance(data.get('requests'), list):
+        raise BadRequestException('No requests received')
+    max_size = current_app.config.get(
+        'SANDMAN_BATCH_MAX_SIZE', DEFAULT_MAX_SIZE)
+    if len(data['requests']) > max_size:
+        raise BadRequestException(
+            'batch exceeds the maximum of {} requests'.format(max_size))
+    atomic = bool(data.get('atomic'))
+
+    session = _get_session()
+    g._atomic = atomic
+    g._pending_changes = [] if atomic else None
+    results = []
+    status_code = 200
+    try:
+        for sub_request in data['requests']:
+            if not isinstance(sub_request, dict) or 'path' not in sub_request:
+                raise BadRequestException('Each request requires a path')
+            response = _dispatch(
+                sub_request.get('method', 'GET').upper(),
+                sub_request['path'],
+                sub_request.get('body'))
+            results.append(_as_result(response))
+            if atomic and response.status_code >= 400:
+                status_code = response.status_code
+                break
+        if atomic and status_code == 200:
+            session.commit()
+            bus = get_bus(current_app)
+            for change in g._pending_changes:
+                bus.publish(*change)
+        elif atomic:
+            session.rollback()
+    except Exception:
+        if atomic:
+            session.rollback()
+        raise
+    finally:
+        g._atomic = False
+        g._pending_changes = None
+
+    response = jsonify({
+        'committed': not atomic or status_code == 200,
+        'responses': results})
+    response.status_code = status_code
+    return response
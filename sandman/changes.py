@@ -0,0 +1,262 @@
+"""In-process change feed for registered resources.
+
+Every successful write made through :class:`sandman.models.Model` publishes
+an event to a :class:`ChangeBus`. Clients subscribe to
+``/<endpoint>/changes`` either as a Server-Sent Events stream (``Accept:
+text/event-stream``) or by long-polling for JSON, and receive only the
+changes made since their resume token instead of re-downloading the
+collection.
+
+A resume token is sent as the SSE event id (and so returned by browsers in
+the ``Last-Event-ID`` header) or as the ``token`` of a long-poll response,
+to be passed back as ``?since=``. If the changes since a token are no longer
+retained, or a subscriber falls too far behind, a ``reset`` event is sent
+and the client should fetch the collection again.
+
+Configuration:
+
+* ``SANDMAN_CHANGE_HISTORY``: events retained per endpoint for resuming
+* ``SANDMAN_CHANGE_BUFFER``: events buffered per subscriber before it is
+  reset
+* ``SANDMAN_CHANGE_KEEPALIVE``: seconds between SSE keepalive comments
+* ``SANDMAN_CHANGE_POLL_TIMEOUT``: longest a long-poll request may wait
+
+The bus lives in a single process; with ``sandman serve`` subscribers only
+see writes handled by the same worker.
+"""
+import collections
+import json
+import math
+import threading
+import time
+import uuid
+
+from flask import Response, current_app, g, jsonify, request
+
+from sandman.admission import detach_request
+from sandman.exception import BadRequestException
+
+DEFAULT_HISTORY = 1000
+DEFAULT_BUFFER = 100
+DEFAULT_KEEPALIVE = 15
+DEFAULT_POLL_TIMEOUT = 30
+
+EVENT_STREAM = 'text/event-stream'
+
+
+class Subscription(object):
+    """A single subscriber's bounded buffer of pending events."""
+
+    def __init__(self, endpoint, max_pending):
+        self.endpoint = endpoint
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.reset = False
+
+    def push(self, event):
+        """Buffer *event*, resetting the subscriber if it has fallen too far
+        behind."""
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.pending.clear()
+                self.reset = True
+            else:
+                self.pending.append(event)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """Wait up to *timeout* seconds for events. Return ``(reset,
+        events)``."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.pending and not self.reset:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            reset, self.reset = self.reset, False
+            events = list(self.pending)
+            self.pending.clear()
+            return reset, events
+
+
+class ChangeBus(object):
+    """Fans change events out to the subscribers of each endpoint."""
+
+    def __init__(self, history=DEFAULT_HISTORY, buffer_size=DEFAULT_BUFFER):
+        # Tokens from a previous process (or bus) can't be resumed
+        self.epoch = uuid.uuid4().hex[:8]
+        self.buffer_size = buffer_size
+        self.history_size = history
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.history = {}
+        self.subscribers = {}
+
+    def token(self, event_id):
+        """Return the resume token for *event_id*."""
+        return '{}-{}'.format(self.epoch, event_id)
+
+    def _parse_token(self, token):
+        """Return the event id encoded in *token*, or ``None`` if it can't be
+        resumed from."""
+        epoch, _, event_id = token.partition('-')
+        if epoch != self.epoch:
+            return None
+        try:
+            return int(event_id)
+        except ValueError:
+            raise BadRequestException('invalid resume token')
+
+    def publish(self, endpoint, operation, resource_id, resource=None):
+        """Publish a change to *endpoint* to its subscribers."""
+        with self.lock:
+            self.last_id += 1
+            event = {
+                'id': self.token(self.last_id),
+                'operation': operation,
+                'resource_id': resource_id,
+                'resource': resource,
+                }
+            self.history.setdefault(
+                endpoint,
+                collections.deque(maxlen=self.history_size)).append(
+                    (self.last_id, event))
+            subscribers = list(self.subscribers.get(endpoint, ()))
+        for subscription in subscribers:
+            subscription.push(event)
+
+    def subscribe(self, endpoint, token=None):
+        """Return a :class:`Subscription` to *endpoint*, replaying the events
+        published after *token*."""
+        subscription = Subscription(endpoint, self.buffer_size)
+        since = self._parse_token(token) if token else None
+        with self.lock:
+            self.subscribers.setdefault(endpoint, set()).add(subscription)
+            if token is None:
+                return subscription
+            history = self.history.get(endpoint, ())
+            # Event ids are shared by all endpoints, so events may only have
+            # been missed if this endpoint's history has started evicting
+            evicted = (len(history) == self.history_size and
+                       since is not None and since < history[0][0] - 1)
+            if since is None or evicted or since > self.last_id:
+                subscription.reset = True
+                return subscription
+            for event_id, event in history:
+                if event_id > since:
+                    subscription.push(event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop delivering events to *subscription*."""
+        with self.lock:
+            self.subscribers.get(subscription.endpoint, set()).discard(
+                subscription)
+
+
+def get_bus(app):
+    """Return (and memoize) the :class:`ChangeBus` for *app*."""
+    bus = app.extensions.get('sandman_changes')
+    if bus is None:
+        bus = app.extensions['sandman_changes'] = ChangeBus(
+            history=app.config.get('SANDMAN_CHANGE_HISTORY', DEFAULT_HISTORY),
+            buffer_size=app.config.get(
+                'SANDMAN_CHANGE_BUFFER', DEFAULT_BUFFER))
+    return bus
+
+
+def publish(endpoint, operation, resource_id, resource=None):
+    """Publish a change made during the current request. Changes made in an
+    atomic batch are held back until the batch commits."""
+    pending = getattr(g, '_pending_changes', None)
+    if pending is not None:
+        pending.append((endpoint, operation, resource_id, resource))
+        return
+    get_bus(current_app).publish(endpoint, operation, resource_id, resource)
+
+
+def _sse_event(event):
+    """Return *event* formatted as a Server-Sent Event."""
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event['id'], event['operation'], json.dumps(event, default=str))
+
+
+def _event_stream(subscription, keepalive):
+    """Yield Server-Sent Events for *subscription* until the client goes
+    away."""
+    while True:
+        reset, events = subscription.get(keepalive)
+        if reset:
+            yield 'event: reset\ndata: {}\n\n'
+        for event in events:
+            yield _sse_event(event)
+        if not reset and not events:
+            yield ': keepalive\n\n'
+
+
+def _poll_timeout(app):
+    """Return the seconds a long-poll request may wait, as asked for by its
+    ``timeout`` argument and capped by ``SANDMAN_CHANGE_POLL_TIMEOUT``."""
+    limit = app.config.get('SANDMAN_CHANGE_POLL_TIMEOUT', DEFAULT_POLL_TIMEOUT)
+    try:
+        timeout = float(request.args.get('timeout', limit))
+    except ValueError:
+        raise BadRequestException('invalid timeout')
+    # ``nan`` would never time out
+    if math.isnan(timeout) or math.isinf(timeout):
+        raise BadRequestException('invalid timeout')
+    return max(0.0, min(timeout, limit))
+
+
+def changes(endpoint):
+    """Return the changes made to *endpoint*, as an event stream or a
+    long-poll JSON response."""
+    app = current_app
+    bus = get_bus(app)
+    token = request.args.get(
+        'since', request.headers.get('Last-Event-ID'))
+    stream = EVENT_STREAM in request.headers.get('Accept', '')
+    # Arguments are checked before subscribing, so a bad request can't leave
+    # a subscriber behind
+    timeout = None if stream else _poll_timeout(app)
+    subscription = bus.subscribe(endpoint, token)
+
+    if stream:
+        # The stream is sent after the request is torn down, so it holds any
+        # admission slots itself until the client goes away
+        admitted = detach_request()
+
+        def close():
+            """Release the subscription and slots held by the stream."""
+            bus.unsubscribe(subscription)
+            for limiter in admitted:
+                limiter.release()
+        response = Response(
+            _event_stream(
+                subscription,
+                app.config.get('SANDMAN_CHANGE_KEEPALIVE', DEFAULT_KEEPALIVE)),
+            mimetype=EVENT_STREAM)
+        # Called when the server closes the response, even if the stream was
+        # never started
+        response.call_on_close(close)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    try:
+        reset, events = subscription.get(timeout)
+    finally:
+        bus.unsubscribe(subscription)
+    if events:
+        token = events[-1]['id']
+    elif reset or token is None:
+        with bus.lock:
+            token = bus.token(bus.last_id)
+    return jsonify({'reset': reset, 'changes': events, 'token': token})
+
+
+# Subscribers hold their request open waiting for changes, so they mustn't
+# take up global concurrency slots (see :mod:`sandman.admission`)
+changes.long_lived = True
@@ -0,0 +1,126 @@
+"""Coalescing of identical concurrent reads.
+
+When ``SANDMAN_COALESCE_READS`` is set, a GET arriving while an identical
+GET (same endpoint, URL arguments, query string and negotiated content type)
+is in flight waits for that request to finish and is sent a copy of its
+serialized response rather than running the query again. Followers wait at
+most ``SANDMAN_COALESCE_TIMEOUT`` seconds before giving up and computing the
+response themselves.
+"""
+import threading
+
+from flask import current_app, g, request
+
+from sandman.content_negotiation import _get_acceptable_response_type
+
+DEFAULT_TIMEOUT = 5.0
+
+
+class _Call(object):
+    """A computation in flight, and eventually its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """Runs at most one computation per key at a time, sharing its outcome
+    with every caller that asks for the same key meanwhile."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.followers = 0
+        self.timeouts = 0
+
+    def do(self, key, function):
+        """Return the result of *function*, or of the identical call already
+        in flight for *key*."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if leader:
+            try:
+                call.result = function()
+            except Exception as exception:
+                call.exception = exception
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(self.timeout):
+            with self.lock:
+                self.timeouts += 1
+            return function()
+        if call.exception is not None:
+            raise call.exception
+        return call.result
+
+    def stats(self):
+        """Return the number of leaders, followers and timeouts, and the
+        coalescing ratio."""
+        with self.lock:
+            total = self.leaders + self.followers
+            return {
+                'in_flight': len(self.calls),
+                'leaders': self.leaders,
+                'followers': self.followers,
+                'timeouts': self.timeouts,
+                'coalescing_ratio': (
+                    float(self.followers) / total if total else 0.0),
+                }
+
+
+def get_single_flight(app):
+    """Return (and memoize) the :class:`SingleFlight` for *app*."""
+    single_flight = app.extensions.get('sandman_coalescing')
+    if single_flight is None:
+        single_flight = app.extensions['sandman_coalescing'] = SingleFlight(
+            app.config.get('SANDMAN_COALESCE_TIMEOUT', DEFAULT_TIMEOUT))
+    return single_flight
+
+
+def _request_key():
+    """Return the key identifying requests which get identical
+    responses."""
+    return (
+        request.endpoint,
+        tuple(sorted((request.view_args or {}).items())),
+        tuple(sorted(request.args.items(multi=True))),
+        _get_acceptable_response_type(),
+        )
+
+
+def coalesce(view):
+    """Return the response of *view*, a function rendering the response to
+    the current GET request, shared with identical concurrent requests if
+    coalescing is enabled."""
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    # Requests in an atomic batch must see their batch's uncommitted writes
+    if not app.config.get('SANDMAN_COALESCE_READS') or getattr(
+            g, '_atomic', False):
+        return view()
+
+    def render():
+        """Render and serialize the response."""
+        response = app.make_response(view())
+        return (
+            response.get_data(),
+            response.status_code,
+            list(response.headers.items()))
+
+    body, status, headers = get_single_flight(app).do(_request_key(), render)
+    return app.response_class(body, status=status, headers=headers)
@@ -101,3 +101,7 @@ class ServiceUnavailableException(EndpointException):
     error."""
 
     code = 503
+
+    def __init__(self, message=None, payload=None, retry_after=None):
+        super(ServiceUnavailableException, self).__init__(message, payload)
+        self.retry_after = retry_after
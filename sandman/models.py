@@ -1,16 +1,21 @@
 """SQLAlchemy-based models for use in sandman."""
 import datetime
 import decimal
+import re
 
 from flask import jsonify, request, make_response, g, render_template
 from flask.views import MethodView
 from flask.ext.sqlalchemy import SQLAlchemy  # pylint:disable=no-name-in-module,import-error
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 
 from sandman.exception import (
     NotFoundException,
     BadRequestException,
     )
 from sandman.utils import verify_fields
+from sandman.changes import publish
+from sandman.coalesce import coalesce
 from sandman.response import collection_as_dict, resource_as_dict
 from sandman.content_negotiation import (
     _get_acceptable_response_type,
@@ -20,6 +25,33 @@ from sandman.content_negotiation import (
 
 db = SQLAlchemy()  # pylint: disable=invalid-name
 
+# Query string arguments which are not column filters
+NON_FILTER_ARGUMENTS = ('page', 'aggregate', 'group_by', 'q')
+
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'avg', 'min', 'max')
+AGGREGATE_EXPRESSION = re.compile(r'^(\w+)(?:\(([^()]+)\))?$')
+
+# Dialect-specific INSERT constructs supporting ``ON CONFLICT``, by dialect
+# name. Not every SQLAlchemy version ships all of them.
+_CONFLICT_INSERTS = {}
+try:
+    from sqlalchemy.dialects.postgresql import insert as _postgresql_insert
+    _CONFLICT_INSERTS['postgresql'] = _postgresql_insert
+except ImportError:
+    pass
+try:
+    from sqlalchemy.dialects.sqlite import insert as _sqlite_insert
+    _CONFLICT_INSERTS['sqlite'] = _sqlite_insert
+except ImportError:
+    pass
+# MySQL's ``ON DUPLICATE KEY UPDATE`` can upsert, but can't be used to skip
+# conflicting rows: with the CLIENT_FOUND_ROWS flag SQLAlchemy sets, a row
+# left unchanged is counted as affected just like one inserted.
+try:
+    from sqlalchemy.dialects.mysql import insert as _mysql_insert
+except ImportError:
+    _mysql_insert = None
+
 
 def _get_session():
     """Return (and memoize) a database session"""
@@ -29,15 +61,95 @@ def _get_session():
     return session
 
 
+def _serializable(value):
+    """Return *value* in a form which can be serialized to JSON."""
+    if isinstance(value, (datetime.datetime, decimal.Decimal)):
+        return str(value)
+    return value
+
+
+def _split_argument(name):
+    """Return the comma-separated values of query string argument *name*."""
+    return [value.strip() for value in request.args.get(name, '').split(',')
+            if value.strip()]
+
+
+def _commit(session):
+    """Commit the request's changes, unless the request is part of an atomic
+    batch, which is committed once all of its requests have succeeded."""
+    if getattr(g, '_atomic', False):
+        session.flush()
+    else:
+        session.commit()
+
+
+def _supports_returning(dialect):
+    """Return True if *dialect* supports ``INSERT ... RETURNING``."""
+    return getattr(dialect, 'insert_returning', dialect.name == 'postgresql')
+
+
+def _insert(table, dialect):
+    """Return an INSERT into *table* which does nothing if it conflicts with
+    any of the table's unique or primary key constraints, and whether the
+    dialect supports doing so. Otherwise, a conflict raises
+    :class:`sqlalchemy.exc.IntegrityError`."""
+    insert = _CONFLICT_INSERTS.get(dialect.name)
+    if insert is None:
+        return table.insert(), False
+    return insert(table).on_conflict_do_nothing(), True
+
+
+def _upsert(table, dialect, values, updates):
+    """Return an INSERT of *values* into *table* which applies *updates* to
+    the existing row if its primary key is already taken."""
+    if dialect.name == 'mysql' and _mysql_insert is not None:
+        statement = _mysql_insert(table).values(**values)
+        # Without updates, setting the key to itself leaves the row as is
+        return statement.on_duplicate_key_update(**(updates or dict(
+            (column.name, column) for column in table.primary_key.columns)))
+    insert = _CONFLICT_INSERTS.get(dialect.name)
+    if insert is None:
+        return table.insert().values(**values)
+    statement = insert(table).values(**values)
+    if not updates:
+        return statement.on_conflict_do_nothing()
+    return statement.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns), set_=updates)
+
+
+def _execute(session, statement):
+    """Execute *statement*, turning constraint violations into a 400."""
+    try:
+        return session.execute(statement)
+    except IntegrityError:
+        session.rollback()
+        raise BadRequestException('resource violates a constraint')
+
+
+def _with_primary_key(table, values, primary_key):
+    """Return *values* with the generated *primary_key* of an inserted row
+    filled in."""
+    values = dict(values)
+    for column, value in zip(table.primary_key.columns, primary_key or ()):
+        values.setdefault(column.name, value)
+    return values
+
+
 class Model(MethodView):
     """Base class for all resources."""
 
     __model__ = None
     __app__ = None
     __endpoint__ = None
+    __search_index__ = None
+    __validator__ = None
 
     def get(self, resource_id=None):
         """Return response to HTTP GET request."""
+        return coalesce(lambda: self._get(resource_id))
+
+    def _get(self, resource_id):
+        """Render the response to an HTTP GET request."""
         if resource_id is None:
             return self._all_resources()
         else:
@@ -48,34 +160,20 @@ class Model(MethodView):
 
     def _all_resources(self):
         """Return all resources of this type as a JSON list."""
-        query_arguments = request.args
-        filters = []
-        order = []
-        resources = None
-        if query_arguments:
-            for key, value in query_arguments.items():
-                if key == 'page':
-                    continue
-                if value.startswith('%'):
-                    filters.append(getattr(self.__model__, key).like(
-                        str(value), escape='/'))
-                elif key == 'sort':
-                    order.append(getattr(self.__model__, value))
-                elif key:
-                    filters.append(getattr(self.__model__, key) == value)
+        if 'aggregate' in request.args or 'group_by' in request.args:
+            return self._aggregate()
+        filters, order = self._filters()
         if filters:
-            print filters
             resources = _get_session().query(  # pylint: disable=star-args
                 self.__model__).filter(*filters)
         else:
             resources = _get_session().query(self.__model__)
+        if 'q' in request.args:
+            resources = self._search(resources)
         if order:
             resources = resources.order_by(  # pylint: disable=star-args
                 *order)
-        if 'page' in query_arguments:
-            resources = resources.limit(20).offset(
-                20 * int(request.args['page']))
-        resources = resources.all()
+        resources = self._paginate(resources).all()
 
         content_type = _get_acceptable_response_type()
         if content_type == JSON:
@@ -89,65 +187,261 @@ class Model(MethodView):
                 'collection.html',
                 resources=resources)
 
+    def _aggregate(self):
+        """Return the aggregates requested in the query string, computed
+        entirely by the database.
+
+        ``aggregate`` is a comma-separated list of ``count``, ``count(col)``,
+        ``sum(col)``, ``avg(col)``, ``min(col)`` and ``max(col)``, and
+        ``group_by`` a comma-separated list of columns. Column filters,
+        ``q``, ``sort`` and ``page`` apply as they do to the collection,
+        except that only grouped columns and aggregates can be sorted on.
+        """
+        group_by = [self._column(name)
+                    for name in _split_argument('group_by')]
+        aggregates = [self._aggregate_function(expression)
+                      for expression in _split_argument('aggregate')]
+        if not aggregates:
+            aggregates = [func.count().label('count')]
+        # Any other column isn't in the result, and can't be sorted on
+        sortable = dict(
+            (column.name, column) for column in group_by + aggregates)
+        filters, order = self._filters(sortable)
+        query = _get_session().query(  # pylint: disable=star-args
+            *(group_by + aggregates)).select_from(self.__model__)
+        if filters:
+            query = query.filter(*filters)  # pylint: disable=star-args
+        if 'q' in request.args:
+            # Ordering by relevance means nothing once rows are aggregated
+            query = self._search(query, ranked=False)
+        if group_by:
+            query = query.group_by(*group_by)  # pylint: disable=star-args
+        if order or group_by:
+            query = query.order_by(  # pylint: disable=star-args
+                *(order or group_by))
+        resources = [
+            dict((key, _serializable(value))
+                 for key, value in row._asdict().items())
+            for row in self._paginate(query).all()]
+
+        content_type = _get_acceptable_response_type()
+        if content_type == JSON:
+            response = jsonify({'resources': resources})
+            response.status_code = 200
+            return response
+        else:
+            assert content_type == HTML
+            return render_template(
+                'collection.html',
+                resources={'resources': resources})
+
+    def _search(self, query, ranked=True):
+        """Return *query* limited to the resources matching the ``q``
+        argument, best match first if *ranked*."""
+        if self.__search_index__ is None:
+            raise BadRequestException(
+                '[{}] is not searchable'.format(self.endpoint()))
+        terms = request.args['q'].strip()
+        if not terms:
+            raise BadRequestException('empty search query')
+        return self.__search_index__.search(query, terms, ranked)
 
+    def _column(self, name):
+        """Return the column *name* of the underlying table, or raise a
+        :class:`BadRequestException` if there is no such column."""
+        try:
+            return self.__model__.__table__.columns[name]
+        except KeyError:
+            raise BadRequestException('unknown column [{}]'.format(name))
+
+    def _aggregate_function(self, expression):
+        """Return the labelled SQL aggregate for an *expression* such as
+        ``sum(Total)``."""
+        match = AGGREGATE_EXPRESSION.match(expression)
+        if not match or match.group(1) not in AGGREGATE_FUNCTIONS:
+            raise BadRequestException(
+                'invalid aggregate [{}]'.format(expression))
+        function, column = match.groups()
+        if column is None:
+            if function != 'count':
+                raise BadRequestException(
+                    '[{}] requires a column'.format(function))
+            return func.count().label('count')
+        return getattr(func, function)(self._column(column)).label(
+            '{}_{}'.format(function, column))
+
+    def _filters(self, sortable=None):
+        """Return the filters and ordering requested in the query string.
+        Any column may be sorted on, unless a dict of the *sortable* columns
+        by name is given."""
+        filters = []
+        order = []
+        for key, value in request.args.items():
+            if key in NON_FILTER_ARGUMENTS:
+                continue
+            if key == 'sort' and sortable is None:
+                order.append(self._column(value))
+            elif key == 'sort':
+                if value not in sortable:
+                    raise BadRequestException(
+                        'can only sort by [{}]'.format(
+                            ', '.join(sorted(sortable))))
+                order.append(sortable[value])
+            elif value.startswith('%'):
+                filters.append(self._column(key).like(
+                    str(value), escape='/'))
+            elif key:
+                filters.append(self._column(key) == value)
+        return filters, order
+
+    @staticmethod
+    def _paginate(query):
+        """Limit *query* to the page requested in the query string, if
+        any."""
+        if 'page' in request.args:
+            query = query.limit(20).offset(20 * int(request.args['page']))
+        return query
 
     @verify_fields
     def post(self):
         """Return response to HTTP POST request."""
-        # pylint: disable=unused-argument
-        resource = _get_session().query(
-            self.__model__).filter_by(**request.json).first()
+        table = self.__model__.__table__
+        session = _get_session()
+        dialect = session.get_bind().dialect
+        statement, ignores_conflicts = _insert(table, dialect)
+        statement = statement.values(**self.body)
+        returning = _supports_returning(dialect)
+        if returning:
+            statement = statement.returning(*table.columns)
+        result = _execute(session, statement)
+        if returning:
+            row = result.first()
+            values = dict(zip(result.keys(), row)) if row else None
+        elif ignores_conflicts and not result.rowcount:
+            values = None
+        else:
+            values = _with_primary_key(
+                table, self.body, result.inserted_primary_key)
         # resource already exists; don't create it again
-        if resource:
+        if values is None:
+            session.rollback()
             raise BadRequestException('resource already exists')
-        resource = self.__model__(  # pylint: disable=not-callable
-            **request.json)
-        _get_session().add(resource)
-        _get_session().commit()
-        return self._created_response(self.to_dict(resource))
+        self._reindex(session, values[self.primarky_key()])
+        _commit(session)
+        resource = self._as_resource_dict(values)
+        publish(self.endpoint(), 'create', resource[self.primarky_key()],
+                resource)
+        return self._created_response(resource)
 
     def delete(self, resource_id):
         """Return response to HTTP DELETE request."""
-        resource = self._resource(resource_id)
-        _get_session().delete(resource)
-        _get_session().commit()
+        resource_id = self._primary_key_value(resource_id)
+        table = self.__model__.__table__
+        session = _get_session()
+        result = _execute(session, table.delete().where(
+            self._primary_key_clause(resource_id)))
+        if not result.rowcount:
+            session.rollback()
+            raise NotFoundException
+        self._reindex(session, resource_id, deleted=True)
+        _commit(session)
+        publish(self.endpoint(), 'delete', resource_id)
         return self._no_content_response()
 
     @verify_fields
     def put(self, resource_id):
         """Return response to HTTP PUT request."""
-        resource = self._resource(resource_id)
-        if resource is None:
-            resource = self.__model__(   # pylint: disable=not-callable
-                **request.json)
-            _get_session().add(resource)
-            _get_session().commit()
-            return self._created_response(self.to_dict(resource))
-        else:
-            resource = self.__model__(  # pylint: disable=not-callable
-                **request.json)
-            _get_session().merge(resource)
-            _get_session().commit()
+        resource_id = self._primary_key_value(resource_id)
+        table = self.__model__.__table__
+        session = _get_session()
+        values = dict(self.body)
+        if values.setdefault(self.primarky_key(), resource_id) != resource_id:
+            raise BadRequestException(
+                'primary key does not match the resource\'s URL')
+        updates = dict(
+            (name, value) for name, value in values.items()
+            if name not in table.primary_key.columns)
+        if updates:
+            result = _execute(session, table.update().where(
+                self._primary_key_clause(resource_id)).values(**updates))
+            if result.rowcount:
+                self._reindex(session, resource_id)
+                _commit(session)
+                publish(self.endpoint(), 'update', resource_id, self.body)
+                return self._no_content_response()
+        elif _execute(session, table.select().where(
+                self._primary_key_clause(resource_id))).first() is not None:
+            # Only the primary key was sent, so there's nothing to replace
             return self._no_content_response()
 
+        # Nothing to replace; create it. An upsert rather than a plain INSERT
+        # so a concurrent PUT of the same resource can't fail with a conflict.
+        dialect = session.get_bind().dialect
+        statement = _upsert(table, dialect, values, updates)
+        returning = _supports_returning(dialect)
+        if returning:
+            statement = statement.returning(*table.columns)
+        result = _execute(session, statement)
+        row = result.first() if returning else None
+        if row:
+            values = dict(zip(result.keys(), row))
+        self._reindex(session, resource_id)
+        _commit(session)
+        resource = self._as_resource_dict(values)
+        publish(self.endpoint(), 'create', resource_id, resource)
+        return self._created_response(resource)
+
     @verify_fields
     def patch(self, resource_id):
         """Return response to HTTP PATCH request."""
-        resource = self._resource(resource_id)
-        if resource:
-            for key, value in request.json.items():
-                setattr(resource, key, value)
-            _get_session().merge(resource)
-            _get_session().commit()
-            resource = self._resource(resource_id)
-            return self._no_content_response()
+        resource_id = self._primary_key_value(resource_id)
+        table = self.__model__.__table__
+        session = _get_session()
+        result = _execute(session, table.update().where(
+            self._primary_key_clause(resource_id)).values(**self.body))
+        if not result.rowcount:
+            session.rollback()
+            raise NotFoundException
+        self._reindex(session, resource_id)
+        _commit(session)
+        publish(self.endpoint(), 'patch', resource_id, self.body)
+        return self._no_content_response()
+
+    def _reindex(self, session, resource_id, deleted=False):
+        """Bring the full-text index, if any, up to date with a write to
+        *resource_id*, in the same transaction."""
+        if self.__search_index__ is None:
+            return
+        if deleted:
+            self.__search_index__.delete(session, resource_id)
         else:
+            self.__search_index__.update(session, resource_id)
+
+    def _primary_key_value(self, resource_id):
+        """Return *resource_id* from the URL coerced to the type of the
+        primary key."""
+        try:
+            return self.__validator__.primary_key_value(resource_id)
+        except ValueError:
             raise NotFoundException
 
+    def _primary_key_clause(self, resource_id):
+        """Return the WHERE clause selecting the row with *resource_id*."""
+        return self.__model__.__table__.columns[
+            self.primarky_key()] == resource_id
+
+    def _as_resource_dict(self, values):
+        """Return the dict representation of a row given its column
+        *values*, without going back to the database."""
+        resource = self.__model__(**values)  # pylint: disable=not-callable
+        resource.resource_id = values.get(self.primarky_key())
+        return self.to_dict(resource)
+
     def _resource(self, resource_id):
         """Return resource represented by this *resource_id*."""
+        resource_id = self._primary_key_value(resource_id)
         resource = _get_session().query(self.__model__).get(resource_id)
-        return jsonify(resource_as_dict(resource, resource_id, self))
+        return resource_as_dict(resource, resource_id, self)
 
     @staticmethod
     def _no_content_response():
@@ -163,6 +457,7 @@ class Model(MethodView):
         if content_type == JSON:
             response = jsonify(resource)
             response.status_code = 201
+            return response
         else:
             assert content_type == HTML
             return render_template('resource.html', resource=resource)
@@ -172,12 +467,7 @@ class Model(MethodView):
         columns."""
         value = {}
         for column in item.__table__.columns:
-            attribute = getattr(item, column.name)
-            if isinstance(attribute, datetime.datetime):
-                attribute = str(attribute)
-            if isinstance(attribute, decimal.Decimal):
-                attribute = str(attribute)
-            value[column.name] = attribute
+            value[column.name] = _serializable(getattr(item, column.name))
             value['links'] = links(item, self.__endpoint__)
         return value
 
@@ -196,6 +486,7 @@ class Model(MethodView):
         if content_type == JSON:
             response = jsonify(resource)
             response.status_code = 200
+            return response
         else:
             assert content_type == HTML
             return render_template(
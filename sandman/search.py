@@ -0,0 +1,267 @@
+"""Full-text search over reflected text columns.
+
+Search is opt-in per model, either by giving the model a ``__searchable__``
+tuple of column names or through the ``SANDMAN_SEARCHABLE`` setting, a dict
+of table name to column names. Searchable collections accept a ``q=``
+argument and return matching resources best match first, with the usual
+filters and paging applied.
+
+Each database uses its native full-text search:
+
+* SQLite: an FTS5 table named ``<table>_fts``, kept in sync by the writes
+  made through :class:`sandman.models.Model`
+* PostgreSQL: a GIN expression index on a ``tsvector`` of the columns (set
+  the text search configuration with ``SANDMAN_SEARCH_LANGUAGE``)
+* MySQL: a ``FULLTEXT`` index
+
+PostgreSQL and MySQL maintain their indexes themselves. A missing index is
+built when the model is registered; ``sandman rebuild-search`` rebuilds
+indexes offline.
+"""
+import abc
+import re
+
+from sqlalchemy import Integer, MetaData, String, inspect, text
+from sqlalchemy.sql import column, table as table_clause
+
+INDEX_SUFFIX = '_fts'
+# The index table and the shadow tables FTS5 creates for it
+INDEX_TABLE = re.compile(r'_fts(_(data|idx|content|docsize|config))?$')
+LANGUAGE = re.compile(r'^\w+$')
+DEFAULT_LANGUAGE = 'simple'
+
+
+def is_index_table(name):
+    """Return True if *name* is a table created for a search index, rather
+    than one which should be exposed as a resource."""
+    return bool(INDEX_TABLE.search(name))
+
+
+# ``class SearchIndex(metaclass=abc.ABCMeta)`` on Python 2 and 3 alike
+_Abstract = abc.ABCMeta('_Abstract', (object, ), {})
+
+
+class SearchIndex(_Abstract):
+    """A full-text index over *columns* of *table*. Subclassed for each
+    database."""
+
+    def __init__(self, table, columns, dialect, language=DEFAULT_LANGUAGE):
+        for name in columns:
+            if name not in table.columns:
+                raise ValueError('[{}] has no column [{}]'.format(
+                    table.name, name))
+            if not isinstance(table.columns[name].type, String):
+                raise ValueError('[{}.{}] is not a text column'.format(
+                    table.name, name))
+        self.table = table
+        self.columns = [table.columns[name] for name in columns]
+        self.primary_key = list(table.primary_key.columns)[0]
+        self.name = table.name + INDEX_SUFFIX
+        self.quote = dialect.identifier_preparer.quote
+        self.language = language
+
+    def _column_list(self):
+        """Return the quoted, comma-separated names of the indexed
+        columns."""
+        return ', '.join(self.quote(col.name) for col in self.columns)
+
+    def exists(self, connection):
+        """Return True if the index has been built."""
+        return self.name in [
+            index['name']
+            for index in inspect(connection).get_indexes(self.table.name)]
+
+    @abc.abstractmethod
+    def drop(self, connection):
+        """Drop the index, if it exists."""
+
+    @abc.abstractmethod
+    def create(self, connection):
+        """Create and populate the index."""
+
+    def rebuild(self, engine):
+        """Drop and rebuild the index from the contents of the table."""
+        with engine.begin() as connection:
+            self.drop(connection)
+            self.create(connection)
+
+    def ensure(self, engine):
+        """Build the index if it doesn't exist."""
+        with engine.begin() as connection:
+            if not self.exists(connection):
+                self.create(connection)
+
+    def update(self, session, resource_id):
+        """Reindex the resource *resource_id* after it's been written."""
+        pass
+
+    def delete(self, session, resource_id):
+        """Remove the resource *resource_id* from the index."""
+        pass
+
+    @abc.abstractmethod
+    def search(self, query, terms, ranked=True):
+        """Return *query* limited to the resources matching *terms*, best
+        match first if *ranked*."""
+
+
+class SQLiteSearchIndex(SearchIndex):
+    """An FTS5 table holding a copy of the indexed columns, keyed by the
+    resource's primary key (as its ``rowid`` for integer keys)."""
+
+    def __init__(self, *args, **kwargs):
+        super(SQLiteSearchIndex, self).__init__(*args, **kwargs)
+        self.integer_key = isinstance(self.primary_key.type, Integer)
+        index = table_clause(
+            self.name, column('rowid'), column('resource_id'), column('rank'))
+        self.index = index
+        self.key = index.c.rowid if self.integer_key else index.c.resource_id
+
+    def exists(self, connection):
+        return self.name in inspect(connection).get_table_names()
+
+    def drop(self, connection):
+        connection.execute(text(
+            'DROP TABLE IF EXISTS {}'.format(self.quote(self.name))))
+
+    def create(self, connection):
+        connection.execute(text(
+            'CREATE VIRTUAL TABLE {} USING fts5(resource_id UNINDEXED, '
+            '{})'.format(self.quote(self.name), self._column_list())))
+        connection.execute(text(self._insert_sql()))
+
+    def _insert_sql(self, where=''):
+        """Return the SQL copying rows of the table into the index."""
+        keys = 'resource_id'
+        values = self.quote(self.primary_key.name)
+        if self.integer_key:
+            keys = 'rowid, ' + keys
+            values = values + ', ' + values
+        return 'INSERT INTO {} ({}, {}) SELECT {}, {} FROM {}{}'.format(
+            self.quote(self.name), keys, self._column_list(), values,
+            self._column_list(), self.quote(self.table.name), where)
+
+    def update(self, session, resource_id):
+        self.delete(session, resource_id)
+        session.execute(
+            text(self._insert_sql(' WHERE {} = :resource_id'.format(
+                self.quote(self.primary_key.name)))),
+            {'resource_id': resource_id})
+
+    def delete(self, session, resource_id):
+        session.execute(
+            text('DELETE FROM {} WHERE {} = :resource_id'.format(
+                self.quote(self.name),
+                'rowid' if self.integer_key else 'resource_id')),
+            {'resource_id': resource_id})
+
+    def search(self, query, terms, ranked=True):
+        # Quote every term so user input can't be parsed as FTS5 syntax
+        terms = ' '.join(
+            '"{}"'.format(term.replace('"', '""')) for term in terms.split())
+        query = query.join(self.index, self.key == self.primary_key).filter(
+            text('{} MATCH :terms'.format(self.quote(self.name))).bindparams(
+                terms=terms))
+        if ranked:
+            query = query.order_by(self.index.c.rank)
+        return query
+
+
+class PostgreSQLSearchIndex(SearchIndex):
+    """A GIN index on a ``tsvector`` expression of the indexed columns."""
+
+    def __init__(self, *args, **kwargs):
+        super(PostgreSQLSearchIndex, self).__init__(*args, **kwargs)
+        if not LANGUAGE.match(self.language):
+            raise ValueError(
+                'invalid text search configuration [{}]'.format(
+                    self.language))
+        # The expression searched must match the indexed one exactly for the
+        # index to be used
+        self.document = "to_tsvector('{}', {})".format(
+            self.language,
+            " || ' ' || ".join(
+                "coalesce({}, '')".format(self.quote(col.name))
+                for col in self.columns))
+        self.terms = "plainto_tsquery('{}', :terms)".format(self.language)
+
+    def exists(self, connection):
+        # Before SQLAlchemy 2.0 the inspector leaves out expression indexes
+        return connection.execute(
+            text('SELECT 1 FROM pg_indexes WHERE indexname = :name AND '
+                 'tablename = :table AND '
+                 'schemaname = coalesce(CAST(:schema AS name), '
+                 'current_schema())'),
+            {'name': self.name, 'table': self.table.name,
+             'schema': self.table.schema}).first() is not None
+
+    def drop(self, connection):
+        connection.execute(text(
+            'DROP INDEX IF EXISTS {}'.format(self.quote(self.name))))
+
+    def create(self, connection):
+        # Workers registering models at once may race to create the index
+        connection.execute(text(
+            'CREATE INDEX IF NOT EXISTS {} ON {} USING GIN ({})'.format(
+                self.quote(self.name), self.quote(self.table.name),
+                self.document)))
+
+    def search(self, query, terms, ranked=True):
+        query = query.filter(
+            text('{} @@ {}'.format(self.document, self.terms)).bindparams(
+                terms=terms))
+        if ranked:
+            query = query.order_by(
+                text('ts_rank({}, {}) DESC'.format(
+                    self.document, self.terms)).bindparams(terms=terms))
+        return query
+
+
+class MySQLSearchIndex(SearchIndex):
+    """A ``FULLTEXT`` index on the indexed columns."""
+
+    def drop(self, connection):
+        if self.exists(connection):
+            connection.execute(text('DROP INDEX {} ON {}'.format(
+                self.quote(self.name), self.quote(self.table.name))))
+
+    def create(self, connection):
+        connection.execute(text('CREATE FULLTEXT INDEX {} ON {} ({})'.format(
+            self.quote(self.name), self.quote(self.table.name),
+            self._column_list())))
+
+    def search(self, query, terms, ranked=True):
+        match = 'MATCH ({}) AGAINST (:terms IN NATURAL LANGUAGE MODE)'.format(
+            self._column_list())
+        query = query.filter(text(match).bindparams(terms=terms))
+        if ranked:
+            query = query.order_by(text(match + ' DESC').bindparams(
+                terms=terms))
+        return query
+
+
+INDEXES = {
+    'sqlite': SQLiteSearchIndex,
+    'postgresql': PostgreSQLSearchIndex,
+    'mysql': MySQLSearchIndex,
+    }
+
+
+def search_index(table, columns, dialect, language=DEFAULT_LANGUAGE):
+    """Return the :class:`SearchIndex` over *columns* of *table* for
+    *dialect*."""
+    if dialect.name not in INDEXES:
+        raise ValueError(
+            'full-text search is not supported on [{}]'.format(dialect.name))
+    return INDEXES[dialect.name](table, columns, dialect, language)
+
+
+def rebuild(engine, searchable, language=DEFAULT_LANGUAGE):
+    """Drop and rebuild the search indexes for *searchable*, a dict of table
+    name to the columns to index."""
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=list(searchable))
+    for name, columns in searchable.items():
+        search_index(
+            metadata.tables[name], columns, engine.dialect,
+            language).rebuild(engine)
@@ -0,0 +1,411 @@
+"""Prefork production server for sandman.
+
+The master process reflects the database and registers every route exactly
+once, then forks worker processes which inherit the reflected metadata,
+mapped classes and URL map copy-on-write. Each worker serves requests from a
+listening socket shared with the master, handling up to ``--threads``
+requests at once so that long-lived requests (change feed streams and
+long-polls) don't monopolize it, and so that admission control and request
+coalescing see concurrent requests.
+
+Signals handled by the master:
+
+* ``SIGHUP``: graceful recycling. A fresh generation of workers is started
+  and the previous generation is asked to finish its in-flight requests and
+  exit. The new workers are forked from the same master, so they serve the
+  schema reflected and the code loaded at startup; restart the master to
+  pick up schema migrations or code changes.
+* ``SIGTTIN``/``SIGTTOU``: add or remove a worker.
+* ``SIGTERM``/``SIGINT``: graceful shutdown.
+"""
+from __future__ import absolute_import
+
+import argparse
+import errno
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+from sqlalchemy import create_engine
+from werkzeug.serving import ThreadedWSGIServer
+
+from sandman import app, reflect_all
+from sandman.models import db
+from sandman.search import rebuild, DEFAULT_LANGUAGE
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 5000
+DEFAULT_WORKERS = 4
+DEFAULT_THREADS = 16
+DEFAULT_BACKLOG = 2048
+DEFAULT_GRACEFUL_TIMEOUT = 30
+
+# How long a worker blocks waiting for a connection before checking whether
+# it has been asked to stop.
+WORKER_POLL_INTERVAL = 1.0
+# How long a worker with every thread busy waits before checking for a free
+# one.
+SLOT_POLL_INTERVAL = 0.05
+
+
+def _dispose_engine():
+    """Drop all pooled connections without closing them for other processes.
+
+    Connections opened before a fork must never be shared between processes,
+    so both the master (before forking) and every worker (after forking) call
+    this.
+    """
+    with app.app_context():
+        try:
+            db.engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33 has no *close* argument
+            db.engine.dispose()
+
+
+def _listen(host, port, backlog):
+    """Return a non-blocking listening socket shared by all workers.
+
+    Non-blocking so that a worker which loses the race for a connection to a
+    sibling gets ``EAGAIN`` instead of blocking inside ``accept``.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    listener.setblocking(False)
+    return listener
+
+
+class BoundedThreadedWSGIServer(ThreadedWSGIServer):
+    """Serves each request in its own thread, running at most *threads* at
+    once.
+
+    A slot in :attr:`slots` must be taken before calling
+    :meth:`handle_request`, so that a worker with all threads busy stops
+    accepting connections, leaving them to its siblings. :attr:`dispatched`
+    tells whether the slot was handed to a request thread or should be given
+    back."""
+
+    def __init__(self, host, port, app, threads=DEFAULT_THREADS, fd=None):
+        ThreadedWSGIServer.__init__(self, host, port, app, fd=fd)
+        self.threads = threads
+        self.slots = threading.BoundedSemaphore(threads)
+        self.dispatched = False
+
+    def process_request(self, request, client_address):
+        self.dispatched = True
+        try:
+            ThreadedWSGIServer.process_request(self, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadedWSGIServer.process_request_thread(
+                self, request, client_address)
+        finally:
+            self.slots.release()
+
+    def drain(self, timeout):
+        """Wait up to *timeout* seconds for in-flight requests to finish."""
+        deadline = time.time() + timeout
+        for _ in range(self.threads):
+            while not self.slots.acquire(False):
+                if time.time() >= deadline:
+                    return
+                time.sleep(0.1)
+
+
+class Worker(object):
+    """A single forked worker process serving requests from the shared
+    listening socket."""
+
+    def __init__(self, listener, max_requests=0, threads=DEFAULT_THREADS,
+                 graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT):
+        self.listener = listener
+        self.max_requests = max_requests
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.handled = 0
+        self.handled_lock = threading.Lock()
+        self.alive = True
+        self.master_pid = os.getppid()
+
+    def _handle_term(self, *_):
+        """Finish the in-flight requests, then exit."""
+        self.alive = False
+
+    def _counting_app(self, environ, start_response):
+        """WSGI wrapper counting requests, for worker recycling."""
+        with self.handled_lock:
+            self.handled += 1
+            if self.max_requests and self.handled >= self.max_requests:
+                self.alive = False
+        return app(environ, start_response)
+
+    def run(self):
+        """Serve requests until asked to stop, recycled, or orphaned."""
+        signal.signal(signal.SIGTERM, self._handle_term)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+        signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+        _dispose_engine()
+
+        host, port = self.listener.getsockname()[:2]
+        server = BoundedThreadedWSGIServer(
+            host, port, self._counting_app, threads=self.threads,
+            fd=self.listener.fileno())
+        server.timeout = WORKER_POLL_INTERVAL
+        self._serve(server)
+        server.drain(self.graceful_timeout)
+        server.server_close()
+
+    def _serve(self, server):
+        """Accept connections as threads become free, until asked to stop,
+        recycled, or orphaned."""
+        while self.alive and os.getppid() == self.master_pid:
+            if not server.slots.acquire(False):
+                time.sleep(SLOT_POLL_INTERVAL)
+                continue
+            server.dispatched = False
+            server.handle_request()
+            if not server.dispatched:
+                # Timed out, or the connection was lost or refused
+                server.slots.release()
+
+
+class Arbiter(object):
+    """The master process: owns the listening socket and keeps the configured
+    number of workers alive."""
+
+    def __init__(self, listener, workers=DEFAULT_WORKERS, max_requests=0,
+                 max_requests_jitter=0, threads=DEFAULT_THREADS,
+                 graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT):
+        self.listener = listener
+        self.num_workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        # pid -> generation the worker was started in
+        self.workers = {}
+        self.generation = 0
+        self.signals = []
+
+    def _queue_signal(self, signum, _):
+        """Record a signal to be handled from the main loop."""
+        self.signals.append(signum)
+
+    def _spawn(self):
+        """Fork a single worker for the current generation."""
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            # Spread recycling out so all workers don't restart at once
+            max_requests += random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return
+        exit_code = 0
+        try:
+            random.seed()
+            Worker(
+                self.listener,
+                max_requests,
+                threads=self.threads,
+                graceful_timeout=self.graceful_timeout).run()
+        except Exception:  # pylint: disable=broad-except
+            # Otherwise a worker failing at startup would be respawned over
+            # and over without a trace
+            app.logger.exception('Worker [%s] failed', os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)  # pylint: disable=protected-access
+
+    def _reap(self):
+        """Collect exited workers."""
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as exception:
+                if exception.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+
+    def _kill(self, pids, signum=signal.SIGTERM):
+        """Send *signum* to each of *pids*, ignoring already dead workers."""
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as exception:
+                if exception.errno != errno.ESRCH:
+                    raise
+
+    def _manage_workers(self):
+        """Start or stop current-generation workers to match the configured
+        count."""
+        current = [pid for pid, generation in self.workers.items()
+                   if generation == self.generation]
+        for _ in range(self.num_workers - len(current)):
+            self._spawn()
+        if len(current) > self.num_workers:
+            self._kill(sorted(current)[:len(current) - self.num_workers])
+
+    def reload(self):
+        """Start a new generation of workers, then retire the old one. Workers
+        are recycled, not reconfigured: the schema isn't reflected again and
+        no code is reloaded."""
+        old = list(self.workers)
+        self.generation += 1
+        self._manage_workers()
+        self._kill(old)
+
+    def stop(self):
+        """Ask all workers to exit, killing any that outlive the graceful
+        timeout."""
+        self._kill(list(self.workers))
+        deadline = time.time() + self.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        self._kill(list(self.workers), signal.SIGKILL)
+        self._reap()
+
+    def run(self):
+        """Run the master loop until told to shut down."""
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT,
+                       signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, self._queue_signal)
+        self._manage_workers()
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop()
+                    return
+                elif signum == signal.SIGHUP:
+                    self.reload()
+                elif signum == signal.SIGTTIN:
+                    self.num_workers += 1
+                elif signum == signal.SIGTTOU and self.num_workers > 1:
+                    self.num_workers -= 1
+            self._reap()
+            self._manage_workers()
+            time.sleep(0.5)
+
+
+def serve(database_uri, host=DEFAULT_HOST, port=DEFAULT_PORT,
+          workers=DEFAULT_WORKERS, threads=DEFAULT_THREADS, max_requests=0,
+          max_requests_jitter=0, backlog=DEFAULT_BACKLOG,
+          graceful_timeout=DEFAULT_GRACEFUL_TIMEOUT, searchable=None):
+    """Reflect *database_uri* once and serve it from *workers* forked
+    processes of *threads* threads each."""
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    if searchable:
+        app.config['SANDMAN_SEARCHABLE'] = searchable
+    db.init_app(app)
+    reflect_all()
+    _dispose_engine()
+    if hasattr(gc, 'freeze'):
+        # Move everything built so far out of the collector's generations so
+        # collections in the workers don't touch (and copy) shared pages.
+        gc.collect()
+        gc.freeze()
+
+    listener = _listen(host, port, backlog)
+    Arbiter(
+        listener,
+        workers=workers,
+        threads=threads,
+        max_requests=max_requests,
+        max_requests_jitter=max_requests_jitter,
+        graceful_timeout=graceful_timeout).run()
+    listener.close()
+
+
+def _searchable(specifications):
+    """Return the ``SANDMAN_SEARCHABLE`` dict for a list of ``--search``
+    arguments of the form ``Table=Column,Column``."""
+    searchable = {}
+    for specification in specifications or ():
+        table, _, columns = specification.partition('=')
+        searchable[table] = [name for name in columns.split(',') if name]
+    return searchable
+
+
+def main(argv=None):
+    """Entry point for the ``sandman`` command."""
+    parser = argparse.ArgumentParser(prog='sandman')
+    commands = parser.add_subparsers(dest='command')
+
+    serve_parser = commands.add_parser(
+        'serve', help='serve a database with a prefork server')
+    serve_parser.add_argument('database_uri', help='SQLAlchemy database URI')
+    serve_parser.add_argument('--host', default=DEFAULT_HOST)
+    serve_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument(
+        '-w', '--workers', type=int, default=DEFAULT_WORKERS)
+    serve_parser.add_argument(
+        '-t', '--threads', type=int, default=DEFAULT_THREADS,
+        help='requests each worker handles at once')
+    serve_parser.add_argument(
+        '--max-requests', type=int, default=0,
+        help='recycle a worker after this many requests (0 to disable)')
+    serve_parser.add_argument(
+        '--max-requests-jitter', type=int, default=0,
+        help='add up to this many requests to each worker\'s --max-requests')
+    serve_parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG)
+    serve_parser.add_argument(
+        '--graceful-timeout', type=int, default=DEFAULT_GRACEFUL_TIMEOUT,
+        help='seconds workers are given to finish on shutdown')
+    serve_parser.add_argument(
+        '--search', action='append', metavar='TABLE=COLUMN[,COLUMN...]',
+        help='enable full-text search over these columns of a table')
+
+    rebuild_parser = commands.add_parser(
+        'rebuild-search', help='rebuild full-text search indexes')
+    rebuild_parser.add_argument('database_uri', help='SQLAlchemy database URI')
+    rebuild_parser.add_argument(
+        'search', nargs='+', metavar='TABLE=COLUMN[,COLUMN...]',
+        help='table and columns to index')
+    rebuild_parser.add_argument(
+        '--language', default=DEFAULT_LANGUAGE,
+        help='PostgreSQL text search configuration')
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        serve(
+            args.database_uri,
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            threads=args.threads,
+            max_requests=args.max_requests,
+            max_requests_jitter=args.max_requests_jitter,
+            backlog=args.backlog,
+            graceful_timeout=args.graceful_timeout,
+            searchable=_searchable(args.search))
+        return 0
+    elif args.command == 'rebuild-search':
+        rebuild(
+            create_engine(args.database_uri),
+            _searchable(args.search),
+            args.language)
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
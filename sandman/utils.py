@@ -11,20 +11,34 @@ from sandman.exception import (
 
 
 def verify_fields(function):
-    """A decorator to automatically verify all required JSON fields
-    have been sent."""
+    """A decorator to validate the JSON body of a request against the
+    model's compiled :class:`sandman.validation.Validator`.
+
+    The body is parsed once and its coerced values made available to the
+    decorated method as ``self.body``. All problems with the body are
+    reported together: missing required fields with a 403, otherwise any
+    invalid fields with a 400.
+    """
     @wraps(function)
     def decorated(instance, *args, **kwargs):
         """The decorator function."""
         data = request.get_json(force=True, silent=True)
         if not data:
             raise BadRequestException("No data received from request")
-        for required in instance.__model__.__table__.columns:
-            if required.name in (
-                    instance.__model__.__table__.primary_key.columns):
-                continue
-            if required.name not in data:
-                raise ForbiddenException('{} required'.format(required))
+        if not isinstance(data, dict):
+            raise BadRequestException('Request body must be a JSON object')
+        values, errors, missing = instance.__validator__.validate(
+            data, partial=request.method == 'PATCH')
+        for name in missing:
+            errors[name] = 'required'
+        if missing:
+            raise ForbiddenException(
+                '{} required'.format(', '.join(missing)),
+                payload={'errors': errors})
+        if errors:
+            raise BadRequestException(
+                'invalid request body', payload={'errors': errors})
+        instance.body = values
         return function(instance, *args, **kwargs)
 
     return decorated
@@ -0,0 +1,183 @@
+"""Request body validation compiled from reflected table definitions.
+
+A :class:`Validator` is built once per model when it is registered. It maps
+each column to a coercion function chosen from the column's type, so that
+validating a request body is a single pass over the submitted fields which
+reports every problem at once, before the database is involved.
+"""
+import datetime
+import decimal
+
+from sqlalchemy import Boolean, Integer, String
+
+try:
+    STRING_TYPES = (basestring, )  # pylint: disable=undefined-variable
+except NameError:
+    STRING_TYPES = (str, )
+
+DATETIME_FORMATS = (
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+    )
+DATE_FORMATS = ('%Y-%m-%d', )
+TIME_FORMATS = ('%H:%M:%S.%f', '%H:%M:%S')
+
+
+def _to_integer(value):
+    """Coerce *value* to an ``int``."""
+    if isinstance(value, bool) or isinstance(value, float) and (
+            not value.is_integer()):
+        raise ValueError('expected an integer')
+    try:
+        if isinstance(value, STRING_TYPES + (int, float)):
+            return int(value)
+    except ValueError:
+        pass
+    raise ValueError('expected an integer')
+
+
+def _to_float(value):
+    """Coerce *value* to a ``float``."""
+    if isinstance(value, bool):
+        raise ValueError('expected a number')
+    try:
+        if isinstance(value, STRING_TYPES + (int, float)):
+            return float(value)
+    except ValueError:
+        pass
+    raise ValueError('expected a number')
+
+
+def _to_decimal(value):
+    """Coerce *value* to a :class:`decimal.Decimal`."""
+    if isinstance(value, bool) or not isinstance(
+            value, STRING_TYPES + (int, float)):
+        raise ValueError('expected a number')
+    try:
+        return decimal.Decimal(str(value))
+    except decimal.InvalidOperation:
+        raise ValueError('expected a number')
+
+
+def _to_boolean(value):
+    """Coerce *value* to a ``bool``."""
+    if value in (True, False):
+        return bool(value)
+    raise ValueError('expected a boolean')
+
+
+def _parser(formats, convert=None):
+    """Return a function parsing strings in any of *formats*, passing the
+    resulting :class:`datetime.datetime` through *convert*."""
+    def parse(value):
+        """Parse *value*."""
+        if isinstance(value, STRING_TYPES):
+            for date_format in formats:
+                try:
+                    parsed = datetime.datetime.strptime(value, date_format)
+                except ValueError:
+                    continue
+                return convert(parsed) if convert else parsed
+        raise ValueError('expected a date/time in ISO 8601 format')
+    return parse
+
+
+def _to_string(length):
+    """Return a function checking a value is a string of at most *length*
+    characters."""
+    def coerce(value):
+        """Check *value*."""
+        if not isinstance(value, STRING_TYPES):
+            raise ValueError('expected a string')
+        if length and len(value) > length:
+            raise ValueError(
+                'longer than {} characters'.format(length))
+        return value
+    return coerce
+
+
+def _pass_through(value):
+    """Accept *value* unchanged."""
+    return value
+
+
+COERCIONS = {
+    int: _to_integer,
+    float: _to_float,
+    decimal.Decimal: _to_decimal,
+    bool: _to_boolean,
+    datetime.datetime: _parser(DATETIME_FORMATS),
+    datetime.date: _parser(DATE_FORMATS, lambda parsed: parsed.date()),
+    datetime.time: _parser(TIME_FORMATS, lambda parsed: parsed.time()),
+    }
+
+
+def _coercion(column_type):
+    """Return the coercion function for values of *column_type*."""
+    if isinstance(column_type, String):
+        return _to_string(column_type.length)
+    if isinstance(column_type, Boolean):
+        return _to_boolean
+    if isinstance(column_type, Integer):
+        return _to_integer
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return _pass_through
+    return COERCIONS.get(python_type, _pass_through)
+
+
+class Validator(object):
+    """Validates and coerces request bodies for a single table."""
+
+    def __init__(self, table):
+        self.coercions = {}
+        self.nullable = set()
+        self.required = []
+        primary_key = list(table.primary_key.columns)
+        self.primary_key = primary_key[0].name if primary_key else None
+        for column in table.columns:
+            self.coercions[column.name] = _coercion(column.type)
+            if column.nullable:
+                self.nullable.add(column.name)
+            if (not column.primary_key and not column.nullable and
+                    column.default is None and column.server_default is None):
+                self.required.append(column.name)
+
+    def validate(self, data, partial=False):
+        """Return ``(values, errors, missing)`` for the request body *data*.
+
+        *values* holds the coerced value of each valid field, *errors* a
+        message for each invalid one and *missing* the required columns not
+        present. A *partial* body (as for a PATCH) requires no columns.
+        """
+        values = {}
+        errors = {}
+        missing = []
+        if not partial:
+            missing = [name for name in self.required if name not in data]
+        for name, value in data.items():
+            coerce = self.coercions.get(name)
+            if coerce is None:
+                errors[name] = 'unknown column'
+            elif value is None:
+                if name in self.nullable:
+                    values[name] = None
+                else:
+                    errors[name] = 'may not be null'
+            else:
+                try:
+                    values[name] = coerce(value)
+                except (TypeError, ValueError) as exception:
+                    errors[name] = str(exception)
+        return values, errors, missing
+
+    def primary_key_value(self, resource_id):
+        """Return *resource_id* coerced to the type of the primary key, or
+        raise :class:`ValueError` if it can't be."""
+        if self.primary_key is None:
+            return resource_id
+        return self.coercions[self.primary_key](resource_id)
@@ -2,11 +2,22 @@
 import json
 import os
 import shutil
+import threading
+import time
 
 import pytest
-
-from sandman import app as sandman_app, reflect_all, init_app
-from sandman.models import db
+from sqlalchemy import MetaData, create_engine
+from sqlalchemy.dialects import mssql
+from sqlalchemy.orm import sessionmaker
+
+import sandman
+from sandman import app as sandman_app, reflect_all, init_app, _search_index
+from sandman.admission import Limiter, TokenBucket, get_controller
+from sandman.changes import get_bus
+from sandman.coalesce import SingleFlight, _request_key
+from sandman.exception import ServiceUnavailableException
+from sandman.models import db, Model
+from sandman.search import SearchIndex, search_index
 
 DB_LOCATION = os.path.join(os.getcwd(), 'tests', 'chinook.sqlite3')
 
@@ -61,6 +72,20 @@ def init():
     os.unlink(DB_LOCATION)
 
 
+@pytest.yield_fixture(scope='function')
+def fresh_extensions(app):
+    """Fixture to have the admission controller and request coalescing
+    rebuilt from the settings of a single test."""
+    extensions = ('sandman_admission', 'sandman_coalescing')
+    for name in extensions:
+        app.extensions.pop(name, None)
+
+    yield
+
+    for name in extensions:
+        app.extensions.pop(name, None)
+
+
 
 def test_get_collection(app):
     """Can we get a collection as JSON?"""
@@ -202,3 +227,517 @@ def test_get_sorted_collection(app):
         assert len(json_response['resources']) == 275
         assert json_response['resources'][0]['Name'] == 'A Cor Do Som'
         assert json_response['resources'][274]['Name'] == 'Zeca Pagodinho'
+
+
+@pytest.mark.usefixtures('fresh_extensions')
+def test_rate_limit_sheds_load(app, monkeypatch):
+    """Are requests over the rate limit shed with a 503 and Retry-After?"""
+    monkeypatch.setitem(app.config, 'SANDMAN_RATE_LIMIT', 1)
+    with app.test_client() as test:
+        assert test.get('/artists?page=0').status_code == 200
+        response = test.get('/artists?page=0')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        stats = json.loads(test.get('/admin/admission').get_data())
+        assert stats['global']['rate_limited'] == 1
+
+
+@pytest.mark.usefixtures('fresh_extensions')
+def test_change_feed_exempt_from_concurrency_limit(app, monkeypatch):
+    """Can change feed subscribers connect when all global slots are
+    taken, without being counted against them?"""
+    monkeypatch.setitem(app.config, 'SANDMAN_MAX_CONCURRENT_REQUESTS', 1)
+    controller = get_controller(app)
+    controller.limiter.acquire()
+    with app.test_client() as test:
+        response = test.get('/artists/changes?timeout=0')
+        assert response.status_code == 200
+        assert controller.limiter.stats()['active'] == 1
+        response = test.get('/artists?page=0')
+        assert response.status_code == 503
+
+
+@pytest.mark.usefixtures('fresh_extensions')
+def test_event_stream_holds_endpoint_slot(app, monkeypatch):
+    """Does an event stream hold its per-endpoint slot until it's closed?"""
+    monkeypatch.setitem(
+        app.config, 'SANDMAN_ENDPOINT_LIMITS',
+        {'Artist_changes': {'max_concurrent_requests': 1}})
+    headers = {'Accept': 'text/event-stream'}
+    with app.test_client() as test:
+        stream = test.get('/artists/changes', headers=headers, buffered=False)
+        assert stream.status_code == 200
+        response = test.get(
+            '/artists/changes', headers=headers, buffered=False)
+        assert response.status_code == 503
+        limiter = get_controller(app).endpoint_limiters['Artist_changes']
+        assert limiter.stats()['active'] == 1
+        stream.close()
+        assert limiter.stats()['active'] == 0
+        assert not get_bus(app).subscribers.get('artists')
+
+
+def test_concurrency_limit_rejects_when_queue_full():
+    """Is a request rejected immediately once the wait queue is full?"""
+    limiter = Limiter('test', max_concurrent_requests=1, max_queued_requests=0)
+    limiter.acquire()
+    with pytest.raises(ServiceUnavailableException):
+        limiter.acquire()
+    limiter.release()
+    limiter.acquire()
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_fractional_rate_limit():
+    """Are requests admitted at rates below one per second?"""
+    bucket = TokenBucket(0.5)
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 2
+    bucket.updated -= 2.1
+    assert bucket.take() == 0
+
+
+def test_queued_request_times_out():
+    """Is a queued request shed once it has waited for its queue timeout?"""
+    limiter = Limiter(
+        'test', max_concurrent_requests=1, max_queued_requests=1,
+        queue_timeout=0.05)
+    limiter.acquire()
+    with pytest.raises(ServiceUnavailableException):
+        limiter.acquire()
+    stats = limiter.stats()
+    assert stats['timed_out'] == 1
+    assert stats['queued'] == 0
+    assert stats['rejected'] == 0
+
+
+@pytest.mark.usefixtures('fresh_extensions')
+def test_endpoint_limits(app, monkeypatch):
+    """Are per-endpoint limits applied only to their endpoint?"""
+    monkeypatch.setitem(
+        app.config, 'SANDMAN_ENDPOINT_LIMITS', {'Artist': {'rate_limit': 1}})
+    with app.test_client() as test:
+        assert test.get('/artists?page=0').status_code == 200
+        response = test.get('/artists?page=0')
+        assert response.status_code == 503
+        assert test.get('/albums?page=0').status_code == 200
+        stats = json.loads(test.get('/admin/admission').get_data())
+        assert stats['endpoints']['Artist']['rate_limited'] == 1
+        assert stats['global']['rate_limited'] == 0
+
+
+def test_change_feed_resume(app):
+    """Do we receive only the changes made since our resume token?"""
+    with app.test_client() as test:
+        response = test.get('/artists/changes?timeout=0')
+        token = json.loads(response.get_data())['token']
+        test.patch(
+            '/artists/1',
+            data=json.dumps({'Name': 'Jeff/DC'}),
+            headers={'Content-type': 'application/json'})
+        response = test.get('/artists/changes?timeout=0&since=' + token)
+        json_response = json.loads(response.get_data())
+        assert not json_response['reset']
+        assert len(json_response['changes']) == 1
+        assert json_response['changes'][0]['operation'] == 'patch'
+        assert json_response['changes'][0]['resource'] == {'Name': 'Jeff/DC'}
+
+
+def test_put_primary_key_only(app):
+    """Does a PUT of only the primary key leave an existing resource as it
+    is, and create a missing one?"""
+    with app.test_client() as test:
+        response = test.put(
+            '/artists/1',
+            data=json.dumps({'ArtistId': 1}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 204
+        response = test.get('/artists/1')
+        assert json.loads(response.get_data())['Name'] == 'AC/DC'
+        response = test.put(
+            '/artists/276',
+            data=json.dumps({'ArtistId': 276}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 201
+
+
+def test_change_feed_invalid_timeout(app):
+    """Are timeouts which could never expire rejected, without leaving a
+    subscriber behind?"""
+    with app.test_client() as test:
+        for timeout in ('abc', 'nan', 'inf'):
+            response = test.get('/artists/changes?timeout=' + timeout)
+            assert response.status_code == 400
+        assert test.get('/artists/changes?timeout=-1').status_code == 200
+    assert not get_bus(app).subscribers.get('artists')
+
+
+def test_put_mismatched_primary_key(app):
+    """Do we get a 400 if a PUT body's primary key isn't the one in the
+    URL?"""
+    with app.test_client() as test:
+        response = test.put(
+            '/artists/500',
+            data=json.dumps({'ArtistId': 501, 'Name': 'Jeff/DC'}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 400
+        assert test.get('/artists/501').status_code == 404
+
+
+def test_patch_non_existant_resource(app):
+    """Do we get a 404 if we PATCH a resource that doesn't exist?"""
+    with app.test_client() as test:
+        response = test.patch(
+            '/artists/300',
+            data=json.dumps({'Name': 'Jeff/DC'}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 404
+
+
+def test_delete_non_existant_resource(app):
+    """Do we get a 404 if we DELETE a resource that doesn't exist?"""
+    with app.test_client() as test:
+        response = test.delete('/albums/1000')
+        assert response.status_code == 404
+
+
+def test_aggregate_collection(app):
+    """Can we get aggregates of a collection grouped by a column?"""
+    with app.test_client() as test:
+        response = test.get(
+            '/tracks?group_by=GenreId&aggregate=count,max(Milliseconds)')
+        json_response = json.loads(response.get_data())
+        assert json_response['resources'][0]['GenreId'] == 1
+        assert json_response['resources'][0]['count'] == 1297
+        assert 'max_Milliseconds' in json_response['resources'][0]
+
+
+def test_aggregate_unknown_column(app):
+    """Do we get a 400 if we aggregate over a column that doesn't exist?"""
+    with app.test_client() as test:
+        response = test.get('/tracks?aggregate=sum(foo)')
+        assert response.status_code == 400
+
+
+def test_aggregate_filtered_collection(app):
+    """Do column filters apply to aggregates, and are unknown columns in
+    filters and sorts rejected?"""
+    with app.test_client() as test:
+        response = test.get('/tracks?group_by=GenreId&MediaTypeId=2')
+        json_response = json.loads(response.get_data())
+        assert json_response['resources'][:2] == [
+            {'GenreId': 1, 'count': 84}, {'GenreId': 9, 'count': 34}]
+        response = test.get('/tracks?group_by=GenreId&bogus=1')
+        assert response.status_code == 400
+        response = test.get('/tracks?sort=bogus')
+        assert response.status_code == 400
+
+
+def test_aggregate_sorted(app):
+    """Can we sort aggregates by an aggregate, but not by a column which
+    isn't grouped?"""
+    with app.test_client() as test:
+        response = test.get('/tracks?group_by=GenreId&sort=count')
+        json_response = json.loads(response.get_data())
+        assert json_response['resources'][0] == {'GenreId': 25, 'count': 1}
+        response = test.get('/tracks?group_by=GenreId&sort=Name')
+        assert response.status_code == 400
+
+
+def test_search_index(app):
+    """Does the SQLite full-text index find matches and follow writes?"""
+    # pylint: disable=unused-argument
+    engine = create_engine('sqlite:////' + DB_LOCATION)
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=['Artist'])
+    table = metadata.tables['Artist']
+    index = search_index(table, ['Name'], engine.dialect)
+    index.ensure(engine)
+    session = sessionmaker(bind=engine)()
+
+    results = index.search(session.query(table), 'Pagodinho').all()
+    assert [row.Name for row in results] == ['Zeca Pagodinho']
+
+    session.execute(
+        table.update().where(table.c.ArtistId == 1).values(Name='Jeff/DC'))
+    index.update(session, 1)
+    session.commit()
+    results = index.search(session.query(table), 'Jeff').all()
+    assert [row.ArtistId for row in results] == [1]
+
+
+def test_search_unsupported_dialect(app):
+    """Is search on a database without a search index rejected?"""
+    # pylint: disable=unused-argument
+    engine = create_engine('sqlite:////' + DB_LOCATION)
+    metadata = MetaData()
+    metadata.reflect(bind=engine, only=['Artist'])
+    with pytest.raises(ValueError):
+        search_index(metadata.tables['Artist'], ['Name'], mssql.dialect())
+    with pytest.raises(TypeError):
+        SearchIndex(metadata.tables['Artist'], ['Name'], engine.dialect)
+
+
+def test_search_collection(app, monkeypatch):
+    """Can we search a collection, with results ranked and paged?"""
+    view_class = app.view_functions['Track'].view_class
+    with app.app_context():
+        index = search_index(
+            view_class.__model__.__table__, ['Name'], db.engine.dialect)
+        index.ensure(db.engine)
+    monkeypatch.setattr(view_class, '__search_index__', index)
+    with app.test_client() as test:
+        response = test.get('/tracks?q=love')
+        resources = json.loads(response.get_data())['resources']
+        assert len(resources) == 102
+        assert all('love' in track['Name'].lower() for track in resources)
+        ranked = [track['TrackId'] for track in resources]
+        paged = []
+        for page in range(2):
+            response = test.get('/tracks?q=love&page={}'.format(page))
+            paged.extend(
+                track['TrackId']
+                for track in json.loads(response.get_data())['resources'])
+        assert paged == ranked[:40]
+        response = test.get('/tracks?q=love&aggregate=count')
+        json_response = json.loads(response.get_data())
+        assert json_response['resources'] == [{'count': 102}]
+        response = test.get('/tracks?q=love&group_by=GenreId')
+        json_response = json.loads(response.get_data())
+        assert json_response['resources'][0] == {'GenreId': 1, 'count': 60}
+        assert test.get('/tracks?q=').status_code == 400
+        assert test.get('/tracks?q=%20%20').status_code == 400
+        assert test.get('/artists?q=love').status_code == 400
+
+
+def test_searchable_models(app, monkeypatch):
+    """Are the columns to search taken from the model, then from the
+    SANDMAN_SEARCHABLE setting?"""
+    class Artist(Model):
+        """A model naming its searchable columns."""
+        __tablename__ = 'Artist'
+        __searchable__ = ('Name', )
+
+    class Album(Model):
+        """A model made searchable through the settings."""
+        __tablename__ = 'Album'
+
+    class Genre(Model):
+        """A model which isn't searchable."""
+        __tablename__ = 'Genre'
+
+    monkeypatch.setitem(
+        app.config, 'SANDMAN_SEARCHABLE', {'Album': ['Title']})
+    with app.app_context():
+        tables = db.metadata.tables
+        index = _search_index(Artist, tables['Artist'])
+        assert [col.name for col in index.columns] == ['Name']
+        index = _search_index(Album, tables['Album'])
+        assert [col.name for col in index.columns] == ['Title']
+        assert _search_index(Genre, tables['Genre']) is None
+
+
+def test_reflect_all_skips_index_tables(app, monkeypatch):
+    """Are the tables holding search indexes left out of the API?"""
+    with app.app_context():
+        table = db.metadata.tables['Artist']
+        search_index(table, ['Name'], db.engine.dialect).ensure(db.engine)
+    registered = []
+
+    def register(classes):
+        """Record the tables registered."""
+        registered.extend(cls.__tablename__ for cls in classes)
+    monkeypatch.setattr(sandman, 'register', register)
+    reflect_all()
+    assert 'Artist' in registered
+    assert not [name for name in registered if '_fts' in name]
+
+
+def test_batch(app):
+    """Can we make several requests in a single batch?"""
+    with app.test_client() as test:
+        response = test.post(
+            '/batch',
+            data=json.dumps({'requests': [
+                {'method': 'PATCH', 'path': '/artists/1',
+                 'body': {'Name': 'Jeff/DC'}},
+                {'method': 'GET', 'path': '/artists/1'},
+                {'method': 'GET', 'path': '/artists?page=2'}]}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 200
+        responses = json.loads(response.get_data())['responses']
+        assert [result['status'] for result in responses] == [204, 200, 200]
+        assert len(responses[2]['body']['resources']) == 20
+
+
+def test_atomic_batch_rolls_back(app):
+    """Is nothing committed if a request in an atomic batch fails?"""
+    with app.test_client() as test:
+        response = test.post(
+            '/batch',
+            data=json.dumps({'atomic': True, 'requests': [
+                {'method': 'PATCH', 'path': '/artists/1',
+                 'body': {'Name': 'Jeff/DC'}},
+                {'method': 'PATCH', 'path': '/artists/300',
+                 'body': {'Name': 'Jeff/DC'}}]}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 404
+        assert not json.loads(response.get_data())['committed']
+        response = test.get('/artists/1')
+        assert json.loads(response.get_data())['Name'] == 'AC/DC'
+
+
+def test_batch_too_large(app):
+    """Do we get a 400 if a batch has too many requests?"""
+    with app.test_client() as test:
+        response = test.post(
+            '/batch',
+            data=json.dumps({'requests': [
+                {'path': '/artists/1'}] * 51}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 400
+
+
+@pytest.mark.usefixtures('fresh_extensions')
+def test_batch_sub_requests_are_rate_limited(app, monkeypatch):
+    """Is every request in a batch charged against the rate limits?"""
+    monkeypatch.setitem(
+        app.config, 'SANDMAN_ENDPOINT_LIMITS', {'Artist': {'rate_limit': 1}})
+    with app.test_client() as test:
+        response = test.post(
+            '/batch',
+            data=json.dumps({'requests': [
+                {'path': '/artists?page=0'},
+                {'path': '/artists?page=1'}]}),
+            headers={'Content-type': 'application/json'})
+        responses = json.loads(response.get_data())['responses']
+        assert [result['status'] for result in responses] == [200, 503]
+
+
+def test_batch_unhandled_exception(app, monkeypatch):
+    """Does an unexpected error fail only the sub-request that raised it?"""
+    def fail(_):
+        """Raise an exception no error handler is registered for."""
+        raise RuntimeError('boom')
+    monkeypatch.setattr(Model, '_aggregate', fail)
+    with app.test_client() as test:
+        response = test.post(
+            '/batch',
+            data=json.dumps({'requests': [
+                {'method': 'PATCH', 'path': '/artists/1',
+                 'body': {'Name': 'Jeff/DC'}},
+                {'path': '/tracks?aggregate=count'},
+                {'path': '/artists/1'}]}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 200
+        responses = json.loads(response.get_data())['responses']
+        assert [result['status'] for result in responses] == [204, 500, 200]
+        assert responses[2]['body']['Name'] == 'Jeff/DC'
+
+
+def test_post_invalid_types(app):
+    """Are all invalid fields reported together with a 400?"""
+    with app.test_client() as test:
+        response = test.post(
+            '/tracks',
+            data=json.dumps({
+                'Name': 'Jeff', 'AlbumId': 1, 'MediaTypeId': 'one',
+                'GenreId': 1, 'Composer': None, 'Milliseconds': 1.5,
+                'Bytes': 1, 'UnitPrice': '0.99'}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 400
+        errors = json.loads(response.get_data())['errors']
+        assert sorted(errors) == ['MediaTypeId', 'Milliseconds']
+
+
+def test_post_omitting_nullable_columns(app):
+    """Can we POST a resource without its nullable columns, but not without
+    the others?"""
+    with app.test_client() as test:
+        response = test.post(
+            '/tracks',
+            data=json.dumps({
+                'Name': 'Jeff', 'MediaTypeId': 1, 'Milliseconds': 1000,
+                'UnitPrice': '0.99'}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 201
+        response = test.post(
+            '/tracks',
+            data=json.dumps({'Name': 'Jeff', 'Composer': 'Jeff'}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 403
+        errors = json.loads(response.get_data())['errors']
+        assert sorted(errors) == ['MediaTypeId', 'Milliseconds', 'UnitPrice']
+
+
+def test_patch_coerces_types(app):
+    """Are PATCHed values coerced to their column's type?"""
+    with app.test_client() as test:
+        response = test.patch(
+            '/tracks/1',
+            data=json.dumps({'Milliseconds': '1000'}),
+            headers={'Content-type': 'application/json'})
+        assert response.status_code == 204
+        response = test.get('/tracks?TrackId=1')
+        json_response = json.loads(response.get_data())
+        assert json_response['resources'][0]['Milliseconds'] == 1000
+
+
+def test_single_flight_shares_result():
+    """Do concurrent identical calls share a single computation?"""
+    single_flight = SingleFlight(timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        """Record the call and wait until released."""
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(single_flight.do('key', compute)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(
+        target=lambda: results.append(single_flight.do('key', compute)))
+    follower.start()
+    while not single_flight.stats()['followers']:
+        time.sleep(0.01)
+    release.set()
+    leader.join()
+    follower.join()
+    assert results == ['result', 'result']
+    assert len(calls) == 1
+    assert single_flight.stats()['coalescing_ratio'] == 0.5
+
+
+@pytest.mark.usefixtures('fresh_extensions')
+def test_coalesced_get_resource(app, monkeypatch):
+    """Are single resources and errors still returned with coalescing
+    enabled?"""
+    monkeypatch.setitem(app.config, 'SANDMAN_COALESCE_READS', True)
+    with app.test_client() as test:
+        response = test.get('/artists/1')
+        assert response.status_code == 200
+        assert json.loads(response.get_data())['Name'] == 'AC/DC'
+        assert test.get('/artists/300').status_code == 404
+        stats = json.loads(test.get('/admin/coalescing').get_data())
+        assert stats['leaders'] == 2
+
+
+def test_request_key_normalizes_requests(app):
+    """Do requests differing only in query string order or in how they ask
+    for JSON share a coalescing key?"""
+    def key(path, accept):
+        """Return the coalescing key of a GET of *path*."""
+        with app.test_request_context(path, headers={'Accept': accept}):
+            return _request_key()
+    assert (key('/artists?page=1&sort=Name', '*/*') ==
+            key('/artists?sort=Name&page=1', 'application/json'))
+    assert (key('/artists?page=1', 'application/json') !=
+            key('/artists?page=1', 'text/html'))
+    assert key('/artists/1', '*/*') != key('/artists/2', '*/*')
@@ -0,0 +1,164 @@
+"""Tests for the sandman prefork server."""
+import itertools
+import os
+import threading
+
+import pytest
+
+from sandman import server
+
+
+def test_searchable():
+    """Are --search arguments turned into SANDMAN_SEARCHABLE?"""
+    assert server._searchable(['Artist=Name', 'Track=Name,Composer']) == {
+        'Artist': ['Name'],
+        'Track': ['Name', 'Composer'],
+        }
+    assert server._searchable(None) == {}
+
+
+def test_main_serve(monkeypatch):
+    """Are serve arguments passed through to serve()?"""
+    calls = []
+    monkeypatch.setattr(
+        server, 'serve', lambda *args, **kwargs: calls.append((args, kwargs)))
+    assert server.main([
+        'serve', 'sqlite:///chinook.sqlite3', '-w', '2', '--threads', '8',
+        '--max-requests', '1000', '--search', 'Artist=Name']) == 0
+    args, kwargs = calls[0]
+    assert args == ('sqlite:///chinook.sqlite3', )
+    assert kwargs['workers'] == 2
+    assert kwargs['threads'] == 8
+    assert kwargs['max_requests'] == 1000
+    assert kwargs['port'] == server.DEFAULT_PORT
+    assert kwargs['searchable'] == {'Artist': ['Name']}
+
+
+def test_main_rebuild_search(monkeypatch):
+    """Does rebuild-search rebuild the requested indexes?"""
+    calls = []
+    monkeypatch.setattr(server, 'create_engine', lambda uri: uri)
+    monkeypatch.setattr(
+        server, 'rebuild', lambda *args: calls.append(args))
+    assert server.main([
+        'rebuild-search', 'sqlite:///chinook.sqlite3', 'Artist=Name']) == 0
+    assert calls == [
+        ('sqlite:///chinook.sqlite3', {'Artist': ['Name']},
+         server.DEFAULT_LANGUAGE)]
+
+
+class FakeServer(object):
+    """A server with a single thread, whose first request never finishes if
+    *busy* and which otherwise times out waiting for connections. Stops
+    *worker* after *turns* turns of its loop."""
+
+    def __init__(self, worker, busy, turns):
+        self.slots = threading.BoundedSemaphore(1)
+        self.dispatched = False
+        self.worker = worker
+        self.busy = busy
+        self.turns = turns
+        self.requests = 0
+
+    def handle_request(self):
+        """Wait for a connection."""
+        self.requests += 1
+        self.dispatched = self.busy and self.requests == 1
+        self.turn()
+
+    def turn(self, *_):
+        """Count a turn of the worker's loop."""
+        self.turns -= 1
+        if not self.turns:
+            self.worker.alive = False
+
+
+def test_worker_stops_accepting_when_busy(monkeypatch):
+    """Does a worker with every thread busy leave connections alone?"""
+    worker = server.Worker(None)
+    fake_server = FakeServer(worker, busy=True, turns=5)
+    monkeypatch.setattr(server.time, 'sleep', fake_server.turn)
+    worker._serve(fake_server)
+    assert fake_server.requests == 1
+
+
+def test_worker_returns_unused_slots(monkeypatch):
+    """Is the slot given back when no connection was accepted?"""
+    worker = server.Worker(None)
+    fake_server = FakeServer(worker, busy=False, turns=3)
+    monkeypatch.setattr(server.time, 'sleep', fake_server.turn)
+    worker._serve(fake_server)
+    assert fake_server.requests == 3
+    assert fake_server.slots.acquire(False)
+
+
+def test_worker_failure_logged(monkeypatch):
+    """Is the error which stopped a worker logged before it exits?"""
+    logged = []
+
+    def fail(*args, **kwargs):
+        """Fail to start the worker."""
+        raise RuntimeError('boom')
+
+    def exit_worker(code):
+        """Exit the worker."""
+        raise SystemExit(code)
+    monkeypatch.setattr(server, 'Worker', fail)
+    monkeypatch.setattr(server.os, 'fork', lambda: 0)
+    monkeypatch.setattr(server.os, '_exit', exit_worker)
+    monkeypatch.setattr(
+        server.app.logger, 'exception',
+        lambda message, *args: logged.append(message % args))
+    with pytest.raises(SystemExit) as exit_info:
+        server.Arbiter(None)._spawn()
+    assert exit_info.value.code == 1
+    assert logged == ['Worker [{}] failed'.format(os.getpid())]
+
+
+class TestArbiter(object):
+    """Worker management, with forking and signalling stubbed out."""
+
+    def setup_method(self, _):
+        """Create an arbiter whose workers are fake pids."""
+        self.arbiter = server.Arbiter(None, workers=2)
+        self.killed = []
+        pids = itertools.count(100)
+
+        def spawn():
+            """Record a fake worker for the current generation."""
+            self.arbiter.workers[next(pids)] = self.arbiter.generation
+
+        def kill(pids, signum=None):
+            """Record the workers signalled, and forget them."""
+            # pylint: disable=unused-argument
+            for pid in pids:
+                self.killed.append(pid)
+                self.arbiter.workers.pop(pid, None)
+
+        self.arbiter._spawn = spawn
+        self.arbiter._kill = kill
+
+    def test_manage_workers_spawns(self):
+        """Are missing workers started?"""
+        self.arbiter._manage_workers()
+        assert sorted(self.arbiter.workers) == [100, 101]
+        self.arbiter.workers.pop(100)
+        self.arbiter._manage_workers()
+        assert sorted(self.arbiter.workers) == [101, 102]
+
+    def test_manage_workers_stops_extra(self):
+        """Are surplus workers stopped after the count is reduced?"""
+        self.arbiter.num_workers = 3
+        self.arbiter._manage_workers()
+        self.arbiter.num_workers = 1
+        self.arbiter._manage_workers()
+        assert self.killed == [100, 101]
+        assert list(self.arbiter.workers) == [102]
+
+    def test_reload(self):
+        """Does a reload start a new generation and retire the old one?"""
+        self.arbiter._manage_workers()
+        self.arbiter.reload()
+        assert sorted(self.killed) == [100, 101]
+        assert sorted(self.arbiter.workers) == [102, 103]
+        assert set(self.arbiter.workers.values()) == set([1])